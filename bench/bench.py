@@ -0,0 +1,178 @@
+"""Offline benchmarks for the radar render pipeline.
+
+Uses the fixture PNGs in bench/fixtures (see fixtures.py) and the fake
+EPD backend in fake_epdconfig.py, so neither network nor panel is needed:
+
+    python3 bench/bench.py [--repeat N] [--time-scale S]
+
+--time-scale sets how much of the real panel BUSY time the fake backend
+simulates during the end-to-end run (0 = none, 1 = real time).
+"""
+import argparse
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import fake_epdconfig
+import fixtures
+
+backend = fake_epdconfig.FakeBackend()
+fake_epdconfig.install(backend)
+
+import radar
+from PIL import Image
+from waveshare_epd import epd7in3e, epdconfig
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+        self.raw = io.BytesIO(content)
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class FakeSession:
+    """Serves the fixtures in place of Geoapify and the NOAA WMS."""
+
+    def __init__(self):
+        self.basemap = fixtures.read(fixtures.BASEMAP)
+        self.radar = fixtures.read(fixtures.RADAR)
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return FakeResponse(self.basemap if 'geoapify' in url else self.radar)
+
+
+def bench(name, func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    print(f"{name:<32} {min(times) * 1000:9.1f} {statistics.median(times) * 1000:9.1f}")
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--time-scale', type=float, default=0.0)
+    args = parser.parse_args()
+
+    radar.CACHE_DIR = tempfile.mkdtemp(prefix='radar-bench-')
+    try:
+        viewport = radar.default_viewport()
+        compositor = radar.Compositor(viewport.width, viewport.height)
+        base = Image.open(fixtures.BASEMAP).convert('RGBA')
+        layer = Image.open(fixtures.RADAR).convert('RGBA')
+        overlay = compositor.clear_overlay()
+        radar.draw_annotations(overlay, viewport, radar.load_font())
+        layers = [(layer, radar.RADAR_OPACITY), (overlay, 1.0)]
+        combined = compositor.composite(base, layers).copy()
+        indices = radar.quantize_indices(combined)
+        # EPD.getbuffer, the vendor path, takes an image already in panel colors
+        prepared = radar.Frame(indices).preview
+        epd = epd7in3e.EPD()
+
+        print(f"{'benchmark':<32} {'min ms':>9} {'median ms':>9}")
+        bench('composite', lambda: compositor.composite(base, layers), args.repeat)
+
+        def render_full():
+            radar.Compositor(viewport.width, viewport.height).render(base, layers)
+
+        def render_full_prerendered():
+            radar.Compositor(viewport.width, viewport.height).render(base, layers, None, base_indices)
+
+        base_indices = radar.quantize_indices(base)
+        compositor.render(base, layers)
+        bench('render (full)', render_full, args.repeat)
+        bench('render (full, prerendered base)', render_full_prerendered, args.repeat)
+        bench('render (unchanged)', lambda: compositor.render(base, layers), args.repeat)
+        bench('quantize_indices', lambda: radar.quantize_indices(combined), args.repeat)
+        bench('pack_indices', lambda: radar.pack_indices(indices), args.repeat)
+        bench('EPD.getbuffer', lambda: epd.getbuffer(prepared), args.repeat)
+
+        session = FakeSession()
+        font = radar.load_font()
+        sinks = [radar.make_sink('epd', viewport, epd)]
+
+        def refresh():
+            # Forget the last run so every iteration does a full refresh
+            for name in ('radar.json', f'displayed.{viewport.width}x{viewport.height}.bin'):
+                path = os.path.join(radar.CACHE_DIR, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            backend.reset_log()
+            radar.refresh(sinks, font, session, viewport, compositor)
+
+        backend.time_scale = args.time_scale
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        try:
+            start = time.perf_counter()
+            refresh()
+            cold = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+        print(f"{'refresh (cold map cache)':<32} {cold * 1000:9.1f}")
+        sys.stdout = io.StringIO()
+        try:
+            times = [0.0] * args.repeat
+            for i in range(args.repeat):
+                start = time.perf_counter()
+                refresh()
+                times[i] = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+        print(f"{'refresh (warm map cache)':<32} {min(times) * 1000:9.1f} {statistics.median(times) * 1000:9.1f}")
+        print(f"SPI bytes per refresh: {backend.data_bytes + len(backend.commands)}, "
+              f"HTTP requests: {session.requests}")
+
+        # The file: backend must be left holding the whole frame
+        dump = os.path.join(radar.CACHE_DIR, 'frame.dump')
+        epdconfig.use_backend('file:' + dump)
+        sys.stdout = io.StringIO()
+        try:
+            refresh()
+        finally:
+            sys.stdout = stdout
+            fake_epdconfig.install(backend)
+        size = os.path.getsize(dump)
+        expected = viewport.width * viewport.height // 2
+        print(f"file: backend dump: {size} bytes" + ('' if size == expected else f" (expected {expected})"))
+
+        # --replay over copies of the (palette PNG) radar fixture, which
+        # fixtures.py records over the base map's extent as replay expects
+        frames = os.path.join(radar.CACHE_DIR, 'replay')
+        os.makedirs(frames)
+        shutil.copy(fixtures.BASEMAP, os.path.join(frames, 'basemap.png'))
+        for i in range(args.repeat):
+            shutil.copy(fixtures.RADAR, os.path.join(frames, f'radar{i:03d}.png'))
+        sys.stdout = io.StringIO()
+        try:
+            fps = radar.replay(frames)
+        finally:
+            sys.stdout = stdout
+        print(f"replay: {args.repeat} frames at {fps:.1f} frames/s")
+    finally:
+        shutil.rmtree(radar.CACHE_DIR)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Fake waveshare_epd.epdconfig backend that needs no hardware.
+
+Records every SPI byte and holds the BUSY pin low for a simulated time
+after the panel commands that wait on it, so the EPD driver can be
+exercised and timed on any Linux box.
+"""
+import time
+
+from waveshare_epd import epdconfig
+
+RST_PIN = 17
+DC_PIN = 25
+CS_PIN = 8
+BUSY_PIN = 24
+PWR_PIN = 18
+
+# Approximate BUSY times of the 7.3" (E) panel, in seconds
+BUSY_SECONDS = {
+    0x04: 0.2,    # POWER_ON
+    0x12: 15.0,   # DISPLAY_REFRESH
+    0x02: 0.2,    # POWER_OFF
+}
+
+
+class FakeBackend:
+    """time_scale shrinks simulated BUSY waits and delays (1.0 = real time)."""
+
+    RST_PIN = RST_PIN
+    DC_PIN = DC_PIN
+    CS_PIN = CS_PIN
+    BUSY_PIN = BUSY_PIN
+    PWR_PIN = PWR_PIN
+
+    def __init__(self, time_scale=0.0):
+        self.time_scale = time_scale
+        self.reset_log()
+
+    def reset_log(self):
+        self.commands = []      # (command, number of data bytes that followed)
+        self.data_bytes = 0
+        self.busy_until = 0.0
+        self.dc = 0
+
+    def digital_write(self, pin, value):
+        if pin == DC_PIN:
+            self.dc = value
+
+    def digital_read(self, pin):
+        if pin == BUSY_PIN:
+            return 0 if time.monotonic() < self.busy_until else 1
+        return 0
+
+    def delay_ms(self, delaytime):
+        time.sleep(delaytime / 1000.0 * self.time_scale)
+
+    def _write(self, data):
+        if self.dc:
+            n = len(data)
+            self.data_bytes += n
+            if self.commands:
+                command, count = self.commands[-1]
+                self.commands[-1] = (command, count + n)
+        else:
+            command = data[0]
+            self.commands.append((command, 0))
+            busy = BUSY_SECONDS.get(command)
+            if busy:
+                self.busy_until = time.monotonic() + busy * self.time_scale
+
+    def spi_writebyte(self, data):
+        self._write(data)
+
+    def spi_writebyte2(self, data):
+        self._write(data)
+
+    def module_init(self, cleanup=False):
+        return 0
+
+    def module_exit(self, cleanup=False):
+        pass
+
+
+def install(backend):
+    """Make `backend` the active epdconfig backend."""
+    return epdconfig.use_backend(backend)
@@ -0,0 +1,83 @@
+"""Fixture images for the offline benchmarks.
+
+    python3 bench/fixtures.py record      # save the live base map and radar
+    python3 bench/fixtures.py synthesize  # generate stand-ins, no network needed
+
+Recording uses the settings in radar.py (and its Geoapify key). The radar
+is recorded over the base map's own extent, without the RADAR_SCALE and
+RADAR_OFFSET_* fine-tune, which is what radar.py --replay expects (it
+applies the fine-tune itself); the bench replays this fixture.
+"""
+import os
+import sys
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures')
+BASEMAP = os.path.join(FIXTURES, 'basemap.png')
+RADAR = os.path.join(FIXTURES, 'radar.png')
+
+# NWS base reflectivity colors, 5 to 70 dBZ
+REFLECTIVITY = [
+    (4, 233, 231), (1, 159, 244), (3, 0, 244), (2, 253, 2), (1, 197, 1),
+    (0, 142, 0), (253, 248, 2), (229, 188, 0), (253, 149, 0), (253, 0, 0),
+    (212, 0, 0), (188, 0, 0), (248, 0, 253), (152, 84, 198),
+]
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def record():
+    sys.path.insert(0, os.path.dirname(HERE))
+    import radar
+
+    viewport = radar.default_viewport()
+    session = radar.make_session()
+    radar.get_static_map(viewport.lat, viewport.lon, viewport.zoom, session).save(BASEMAP)
+    # Un-tuned: a fresh Viewport leaves scale and offsets at their defaults
+    extent = radar.Viewport(viewport.lat, viewport.lon, viewport.zoom, viewport.width, viewport.height)
+    image, _ = radar.get_noaa_radar(extent.radar_bbox, (viewport.width, viewport.height), None, session)
+    image.save(RADAR)
+
+
+def synthesize(width=800, height=480, seed=1):
+    rng = np.random.default_rng(seed)
+
+    # Toner-grey style map: light land, darker water, grey roads and borders
+    base = Image.new('RGB', (width, height), (232, 232, 232))
+    draw = ImageDraw.Draw(base)
+    for _ in range(4):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        r = rng.integers(20, 80)
+        draw.ellipse([x - r, y - r // 2, x + r, y + r // 2], fill=(190, 190, 190))
+    for _ in range(60):
+        points = [tuple(int(v) for v in rng.integers(0, (width, height))) for _ in range(3)]
+        draw.line(points, fill=(150, 150, 150), width=int(rng.integers(1, 3)))
+    for _ in range(6):
+        draw.line([(0, int(rng.integers(0, height))), (width, int(rng.integers(0, height)))],
+                  fill=(90, 90, 90), width=1)
+    base.save(BASEMAP)
+
+    # Storm cells: nested blobs stepping up in reflectivity, paletted like WMS PNGs
+    radar = Image.new('P', (width, height), 0)
+    radar.putpalette([0, 0, 0] + [c for rgb in REFLECTIVITY for c in rgb])
+    draw = ImageDraw.Draw(radar)
+    for _ in range(12):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        rx, ry = rng.integers(30, 140), rng.integers(20, 90)
+        levels = int(rng.integers(3, len(REFLECTIVITY)))
+        for level in range(levels):
+            shrink = 1 - level / levels
+            draw.ellipse([x - rx * shrink, y - ry * shrink, x + rx * shrink, y + ry * shrink],
+                         fill=level + 1)
+    radar.save(RADAR, transparency=0)
+
+
+if __name__ == '__main__':
+    os.makedirs(FIXTURES, exist_ok=True)
+    {'record': record, 'synthesize': synthesize}[sys.argv[1] if len(sys.argv) > 1 else 'synthesize']()
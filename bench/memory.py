@@ -0,0 +1,92 @@
+"""Peak memory of decoding a radar download, buffered vs streamed.
+
+    python3 bench/memory.py [--size WxH]
+
+The radar fixture is scaled up to --size (default 2400x1440, a large
+viewport) and written to a temporary file that stands in for the socket.
+Each variant decodes it to RGBA in a fresh interpreter and reports how far
+peak RSS rose above the RSS just before the download:
+
+    buffered  the whole body in memory, BytesIO, Image.open, convert
+    streamed  radar.decode_png over DECODE_CHUNK chunks (PIL still gathers
+              the whole body before decoding, so this matches buffered)
+    reused    the same into a buffer allocated beforehand, as the daemon
+              does with Compositor.radar from the second refresh on
+"""
+import argparse
+import hashlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import fixtures
+
+VARIANTS = ('buffered', 'streamed', 'reused')
+
+
+def chunks(path, size):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def child(variant, path):
+    import fake_epdconfig
+    fake_epdconfig.install(fake_epdconfig.FakeBackend())
+    import numpy as np
+    import radar
+    from PIL import Image
+
+    with Image.open(path) as image:
+        # Touch every page, as a buffer reused across refreshes would be
+        out = np.ones((image.height, image.width, 4), np.uint8) if variant == 'reused' else None
+    before = radar.rss_kb()
+    if variant == 'buffered':
+        content = b''.join(chunks(path, radar.DECODE_CHUNK))
+        sha256 = hashlib.sha256(content).hexdigest()
+        image = Image.open(io.BytesIO(content)).convert('RGBA')
+    else:
+        digest = hashlib.sha256()
+        image = radar.decode_png(chunks(path, radar.DECODE_CHUNK), digest, out)
+        sha256 = digest.hexdigest()
+    print(radar.peak_rss_kb() - before, image.size[0], image.size[1], sha256[:12])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default='2400x1440')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    from PIL import Image
+
+    width, height = map(int, args.size.split('x'))
+    with Image.open(fixtures.RADAR) as image:
+        large = image.resize((width, height), Image.NEAREST)
+    fd, path = tempfile.mkstemp(suffix='.png')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            large.save(f, 'PNG')
+        print(f"{width}x{height} {large.mode} PNG, {os.path.getsize(path) / 1024:.0f} KiB")
+        print(f"{'variant':<12} {'peak KiB':>9}")
+        for variant in VARIANTS:
+            out = subprocess.run([sys.executable, __file__, '--child', variant, path],
+                                 check=True, capture_output=True, text=True).stdout
+            print(f"{variant:<12} {int(out.split()[0]):9d}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
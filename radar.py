@@ -1,181 +1,1325 @@
 import requests
-from PIL import Image, ImageDraw, ImageFont
-from waveshare_epd import epd7in3e
-from io import BytesIO
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+from PIL import Image, ImageDraw, ImageFile, ImageFont
+from waveshare_epd import epd7in3e, epdconfig
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+import argparse
+import hashlib
+import json
 import math
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+import traceback
 
 # Config
-LAT = XX.XXXX
-LON = -YY.YYYY
+LAT = 39.8283    # Replace this
+LON = -98.5795   # Replace this
 ZOOM = 6.5
 WIDTH, HEIGHT = 800, 480
 GEOAPIFY_KEY = "YOUR_GEOAPIFY_API_KEY"  # Replace this
+MAP_STYLE = "toner-grey"
+
+# Base map cache (the map only changes if the settings above do)
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+MAP_CACHE_TTL = 30 * 24 * 3600           # seconds before a cached map is re-downloaded
+MAP_CACHE_MAX_BYTES = 20 * 1024 * 1024   # least recently used maps are evicted past this
+
+DECODE_CHUNK = 64 * 1024  # bytes of a download decoded at a time
+
+# Per-run stage timings are written to cache/report.json and appended to
+# cache/history.jsonl, which keeps the last HISTORY_LENGTH runs (up to twice
+# that between trims)
+HISTORY_LENGTH = 1000
+
+FONT_PATH = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+
+# --daemon mode: refresh every DAEMON_INTERVAL seconds, DAEMON_OFFSET seconds
+# past each wall-clock boundary so NOAA's ~2 minute composite has landed
+DAEMON_INTERVAL = 600
+DAEMON_OFFSET = 90
 
 # --- Radar adjustment (tweak these) ---
 RADAR_SCALE = 1.8     # >1 zoom in, <1 zoom out
 RADAR_OFFSET_X = 0    # positive = shift right, negative = left
 RADAR_OFFSET_Y = -0    # positive = shift down, negative = up
+RADAR_OPACITY = 0.7
+
+# Severity colors: classify each radar pixel to its reflectivity (dBZ) and draw
+# it in solid panel colors by band, instead of blending the radar at
+# RADAR_OPACITY. Bands are (minimum dBZ, panel color); weaker echoes are dropped.
+SEVERITY_COLORS = True
+SEVERITY_BANDS = [
+    (10, (0, 255, 0)),     # light
+    (30, (255, 255, 0)),   # moderate
+    (45, (255, 0, 0)),     # heavy
+    (60, (0, 0, 255)),     # extreme / hail
+]
+
+# Storm motion trail: outlines of the radar from the last TRAIL_FRAMES - 1
+# intervals of TRAIL_STEP minutes, drawn under the current radar (0 = off)
+TRAIL_FRAMES = 0
+TRAIL_STEP = 10
+TRAIL_MAX_BYTES = 8 * 1024 * 1024  # disk budget for stored frames
+TRAIL_COLOR = (0, 0, 0, 255)
 # --------------------------------------
 
-def get_map_bounds_from_zoom(lat, lon, zoom, width, height):
-    # Web Mercator projection
-    def lon_to_x(lon): return (lon + 180) / 360 * 256 * 2**zoom
-    def lat_to_y(lat):
+DITHER = None  # None (nearest color), "ordered" or "floyd-steinberg"
+
+# Skip the panel refresh when fewer pixels than this changed since the last
+# displayed frame (a timestamp tick alone changes a few hundred)
+MIN_CHANGED_PIXELS = 400
+CLEAR_BEFORE_DISPLAY = True  # full white refresh before each frame
+EPD_BUSY_TIMEOUT = 60        # seconds to wait on the panel before giving up
+
+# --config mode: longest side of the one radar image fetched for all sites
+MULTI_MAX_SIZE = 4096
+
+# Panel palette, in nearest-color tie-break order
+PALETTE = np.array([
+    (255, 255, 255), (0, 0, 0), (255, 0, 0),
+    (255, 255, 0), (0, 255, 0), (0, 0, 255)
+], dtype=np.int32)
+
+# 4x4 Bayer threshold matrix, normalised to [-0.5, 0.5)
+BAYER_4X4 = (np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5]
+]) + 0.5) / 16 - 0.5
+ORDERED_SPREAD = 128  # strength of ordered dithering, in RGB units
+
+# Panel color code for each PALETTE entry, matching EPD.getbuffer's palette
+# (0 black, 1 white, 2 yellow, 3 red, 5 blue, 6 green)
+PANEL_CODES = np.array([1, 0, 3, 2, 6, 5], dtype=np.uint8)
+
+# conus_bref_qcd legend: (dBZ, color) of the NWS base reflectivity scale
+REFLECTIVITY_LEGEND = (
+    (5, (4, 233, 231)), (10, (1, 159, 244)), (15, (3, 0, 244)),
+    (20, (2, 253, 2)), (25, (1, 197, 1)), (30, (0, 142, 0)),
+    (35, (253, 248, 2)), (40, (229, 188, 0)), (45, (253, 149, 0)),
+    (50, (253, 0, 0)), (55, (212, 0, 0)), (60, (188, 0, 0)),
+    (65, (248, 0, 253)), (70, (152, 84, 198)), (75, (253, 253, 253)),
+)
+
+# Side of the square tiles a frame is re-rendered in when only part of it
+# changed; a multiple of 4 keeps ordered dithering aligned across tiles
+RENDER_TILE = 32
+
+TILE_SIZE = 256                        # Web Mercator world width in pixels at zoom 0
+MERCATOR_EXTENT = 20037508.342789244   # EPSG:3857 half-width of the world, in meters
+
+class Viewport:
+    """Web Mercator geometry for one map view, computed once and reused.
+
+    Holds the lat/lon bounds, an exact lat/lon -> pixel transform, and the
+    EPSG:3857 bbox to request the radar over so it lands pixel for pixel on
+    the base map, with the RADAR_SCALE / RADAR_OFFSET fine-tune applied.
+    """
+
+    def __init__(self, lat, lon, zoom, width, height, radar_scale=1.0, radar_offset=(0, 0)):
+        self.lat, self.lon, self.zoom = lat, lon, zoom
+        self.width, self.height = width, height
+        self.world_size = TILE_SIZE * 2 ** zoom
+
+        center_x, center_y = self.project(lat, lon)
+        self.left = center_x - width / 2
+        self.top = center_y - height / 2
+        max_lat, min_lon = self.unproject(self.left, self.top)
+        min_lat, max_lon = self.unproject(self.left + width, self.top + height)
+        self.bounds = (min_lat, min_lon, max_lat, max_lon)
+
+        # Fine-tune: scale the radar about the center, then shift it by the
+        # offset in panel pixels
+        span_x, span_y = width / radar_scale, height / radar_scale
+        radar_left = center_x - span_x / 2 - radar_offset[0] / radar_scale
+        radar_top = center_y - span_y / 2 - radar_offset[1] / radar_scale
+        min_x, max_y = self.to_meters(radar_left, radar_top)
+        max_x, min_y = self.to_meters(radar_left + span_x, radar_top + span_y)
+        self.radar_bbox = (min_x, min_y, max_x, max_y)
+
+    def project(self, lat, lon):
+        """Lat/lon to world pixel coordinates."""
+        x = (lon + 180) / 360 * self.world_size
         rad = math.radians(lat)
-        return (1 - math.log(math.tan(rad) + 1 / math.cos(rad)) / math.pi) / 2 * 256 * 2**zoom
+        y = (1 - math.log(math.tan(rad) + 1 / math.cos(rad)) / math.pi) / 2 * self.world_size
+        return x, y
 
-    center_x = lon_to_x(lon)
-    center_y = lat_to_y(lat)
+    def unproject(self, x, y):
+        """World pixel coordinates to lat/lon."""
+        lon = x / self.world_size * 360 - 180
+        n = math.pi - 2 * math.pi * y / self.world_size
+        return math.degrees(math.atan(math.sinh(n))), lon
 
-    half_w = width / 2
-    half_h = height / 2
+    def to_meters(self, x, y):
+        """World pixel coordinates to EPSG:3857 meters."""
+        scale = 2 * MERCATOR_EXTENT / self.world_size
+        return x * scale - MERCATOR_EXTENT, MERCATOR_EXTENT - y * scale
 
-    def x_to_lon(x): return x / (256 * 2**zoom) * 360 - 180
-    def y_to_lat(y):
-        n = math.pi - 2 * math.pi * y / (256 * 2**zoom)
-        return math.degrees(math.atan(math.sinh(n)))
+    def to_pixel(self, lat, lon):
+        x, y = self.project(lat, lon)
+        return int(x - self.left), int(y - self.top)
 
-    min_lon = x_to_lon(center_x - half_w)
-    max_lon = x_to_lon(center_x + half_w)
-    max_lat = y_to_lat(center_y - half_h)
-    min_lat = y_to_lat(center_y + half_h)
+def rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
 
-    return min_lat, min_lon, max_lat, max_lon
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class RunReport:
+    """Timings and memory for each stage of one refresh, saved as JSON."""
+
+    def __init__(self):
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.status = "ok"
+        self.error = None
+        self.stages = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, rss_kb=rss_kb(), peak_rss_kb=peak_rss_kb())
+
+    def call(self, name, func, *args):
+        with self.stage(name):
+            return func(*args)
+
+    def record(self, name, seconds, **extra):
+        self.stages[name] = dict(seconds=round(seconds, 4), **extra)
+
+    def fail(self):
+        self.status = "error"
+        self.error = traceback.format_exc()
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "status": self.status,
+            "error": self.error,
+            "seconds": round(time.perf_counter() - self._start, 4),
+            "peak_rss_kb": peak_rss_kb(),
+            "stages": self.stages,
+        }
+
+    def save(self):
+        line = json.dumps(self.to_dict())
+        save_blob("report.json", line.encode())
+        path = os.path.join(CACHE_DIR, "history.jsonl")
+        with open(path, "a") as f:
+            f.write(line + "\n")
+            size = f.tell()
+        # Most runs only append; the file is cut back to HISTORY_LENGTH runs
+        # once it holds about twice that, going by its size
+        if size > 2 * HISTORY_LENGTH * (len(line) + 1):
+            with open(path) as f:
+                history = f.read().splitlines()
+            if len(history) > 2 * HISTORY_LENGTH:
+                save_blob("history.jsonl", ("\n".join(history[-HISTORY_LENGTH:]) + "\n").encode())
+
+def make_session():
+    """Pooled HTTP session that retries transient failures with backoff."""
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET",))
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=2, pool_maxsize=4)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+def map_cache_path(style, width, height, lat, lon, zoom):
+    key = f"{style}|{width}x{height}|{lon},{lat}|{zoom}"
+    return os.path.join(CACHE_DIR, "map", hashlib.sha256(key.encode()).hexdigest()[:32] + ".png")
+
+def load_cached_map(path, ttl):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if time.time() - st.st_mtime > ttl:
+        return None
+    image = Image.open(path).convert("RGBA")
+    # atime tracks last use for LRU eviction, mtime keeps the download time
+    os.utime(path, (time.time(), st.st_mtime))
+    return image
+
+def evict_cache(directory, max_bytes):
+    # Other processes (--config site workers) may rename or evict files
+    # meanwhile, so names that vanish are skipped
+    entries = []
+    for name in os.listdir(directory):
+        try:
+            st = os.stat(os.path.join(directory, name))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_atime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def get_static_map(lat, lon, zoom, session=requests, size=(WIDTH, HEIGHT)):
+    width, height = size
+    path = map_cache_path(MAP_STYLE, width, height, lat, lon, zoom)
+    cached = load_cached_map(path, MAP_CACHE_TTL)
+    if cached is not None:
+        print("Using cached base map.")
+        return cached
 
-def get_static_map(lat, lon, zoom):
     url = (
         f"https://maps.geoapify.com/v1/staticmap"
-        f"?style=toner-grey&width={WIDTH}&height={HEIGHT}"
+        f"?style={MAP_STYLE}&width={width}&height={height}"
         f"&center=lonlat:{lon},{lat}&zoom={zoom}&apiKey={GEOAPIFY_KEY}"
     )
-    r = requests.get(url, stream=True, timeout=10)
+    r = session.get(url, stream=True, timeout=10)
     r.raise_for_status()
-    return Image.open(r.raw).convert("RGBA")
+    image = decode_png(r.iter_content(DECODE_CHUNK))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    image.save(tmp, "PNG")
+    os.replace(tmp, path)
+    evict_cache(os.path.dirname(path), MAP_CACHE_MAX_BYTES)
+    return image
+
+def load_basemap(lat, lon, zoom, session=requests, size=(WIDTH, HEIGHT), dither=None):
+    """The base map as (H, W, 4) RGBA and (H, W) palette index arrays.
+
+    Both are worked out once per downloaded map and kept beside it in the
+    map cache as .npy files, which later runs memory-map instead of decoding
+    and quantizing the PNG again.
+    """
+    width, height = size
+    path = map_cache_path(MAP_STYLE, width, height, lat, lon, zoom)
+    stem = os.path.splitext(path)[0]
+    paths = (stem + ".rgba.npy", f"{stem}.{dither or 'nearest'}.npy")
+    try:
+        downloaded = os.stat(path).st_mtime
+        if (time.time() - downloaded <= MAP_CACHE_TTL
+                and all(os.stat(p).st_mtime >= downloaded for p in paths)):
+            for p in (path,) + paths:
+                os.utime(p, (time.time(), os.stat(p).st_mtime))
+            print("Using cached base map.")
+            return tuple(np.load(p, mmap_mode="r") for p in paths)
+    except FileNotFoundError:
+        pass
+
+    rgba = np.asarray(get_static_map(lat, lon, zoom, session, size))
+    indices = quantize_indices(np.ascontiguousarray(rgba[..., :3]), dither)
+    for p, array in zip(paths, (rgba, indices)):
+        tmp = p + ".tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp, p)
+    evict_cache(os.path.dirname(path), MAP_CACHE_MAX_BYTES)
+    return rgba, indices
 
-def get_noaa_radar(bounds):
-    min_lat, min_lon, max_lat, max_lon = bounds
+def load_state(name):
+    try:
+        with open(os.path.join(CACHE_DIR, name + ".json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_state(name, state):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, name + ".json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+def save_blob(name, data):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, name)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+class FrameStore:
+    """Frames kept as raw fixed-layout files and memory-mapped back.
+
+    A file holds nothing but pixels and its name gives the layout, e.g.
+    <digest>.800x480.idx for a trail frame (a PALETTE index a pixel) or
+    displayed.800x480.bin (the panel's packed 4-bit buffer), so loading one
+    is an mmap with no decoding or parsing.
+    """
+
+    def __init__(self, directory, width, height):
+        self.directory = directory
+        self.width, self.height = width, height
+
+    def path(self, name, kind):
+        return os.path.join(self.directory, f"{name}.{self.width}x{self.height}.{kind}")
+
+    def shape(self, kind):
+        w, h = self.width, self.height
+        return {"idx": (h, w), "bin": (w * h // 2,)}[kind]
+
+    def save(self, name, kind, data):
+        """Write an array or packed buffer in the `kind` layout."""
+        array = np.frombuffer(data, np.uint8) if isinstance(data, (bytes, bytearray)) else np.asarray(data)
+        if array.dtype != np.uint8 or array.size != np.prod(self.shape(kind)):
+            raise ValueError(f"{name}: not a {self.width}x{self.height} {kind} frame")
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(name, kind)
+        array.tofile(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def load(self, name, kind):
+        """Read-only memory map of a stored frame, or None if there is none."""
+        path = self.path(name, kind)
+        shape = self.shape(kind)
+        try:
+            if os.path.getsize(path) != np.prod(shape):
+                return None
+        except FileNotFoundError:
+            return None
+        return np.memmap(path, np.uint8, "r", shape=shape)
+
+def frame_store(viewport):
+    """The store for the last displayed frame of a view."""
+    return FrameStore(CACHE_DIR, viewport.width, viewport.height)
+
+def get_noaa_radar(bbox, size, previous=None, session=requests, when=None, out=None):
+    """Fetch the radar over an EPSG:3857 bbox, or None if it is unchanged since `previous`.
+
+    `when` asks for the frame valid at that UTC time rather than the latest,
+    and `out` is an optional buffer to decode into (see decode_png).
+    Returns (image, validators); pass the validators back in on the next call.
+    """
+    min_x, min_y, max_x, max_y = bbox
     wms_url = "https://opengeo.ncep.noaa.gov/geoserver/conus/conus_bref_qcd/ows"
     params = {
         "service": "WMS",
         "version": "1.3.0",
         "request": "GetMap",
         "layers": "conus:conus_bref_qcd",
-        "bbox": f"{min_lat},{min_lon},{max_lat},{max_lon}",
-        "crs": "EPSG:4326",
-        "width": WIDTH,
-        "height": HEIGHT,
+        "bbox": f"{min_x},{min_y},{max_x},{max_y}",
+        "crs": "EPSG:3857",
+        "width": size[0],
+        "height": size[1],
         "format": "image/png",
         "transparent": "true"
     }
-    r = requests.get(wms_url, params=params, timeout=10)
+    if when is not None:
+        params["time"] = when.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    request_key = json.dumps(params, sort_keys=True)
+    if previous is None or previous.get("request") != request_key:
+        previous = {}
+
+    headers = {}
+    if previous.get("etag"):
+        headers["If-None-Match"] = previous["etag"]
+    if previous.get("last_modified"):
+        headers["If-Modified-Since"] = previous["last_modified"]
+
+    r = session.get(wms_url, params=params, headers=headers, stream=True, timeout=10)
+    if r.status_code == 304:
+        return None, previous
     r.raise_for_status()
-    return Image.open(BytesIO(r.content)).convert("RGBA")
-
-def adjust_radar(radar):
-    """Scale and offset radar overlay for better alignment."""
-    # Scale
-    new_size = (int(WIDTH * RADAR_SCALE), int(HEIGHT * RADAR_SCALE))
-    radar = radar.resize(new_size, Image.BICUBIC)
-
-    # Center back onto a blank canvas
-    offset_x = (WIDTH - radar.width) // 2 + RADAR_OFFSET_X
-    offset_y = (HEIGHT - radar.height) // 2 + RADAR_OFFSET_Y
-
-    canvas = Image.new("RGBA", (WIDTH, HEIGHT), (0, 0, 0, 0))
-    canvas.paste(radar, (offset_x, offset_y), radar)
-    return canvas
-
-def reduce_opacity(image, alpha_factor):
-    if image.mode != 'RGBA':
-        image = image.convert('RGBA')
-    alpha = image.split()[3]
-    alpha = alpha.point(lambda p: int(p * alpha_factor))
-    image.putalpha(alpha)
-    return image
 
-def latlon_to_pixel(lat, lon, bounds, image_size):
-    min_lat, min_lon, max_lat, max_lon = bounds
-    width, height = image_size
-    x = (lon - min_lon) / (max_lon - min_lon) * width
-    y = (max_lat - lat) / (max_lat - min_lat) * height
-    return int(x), int(y)
-
-def prepare_for_epd(image):
-    palette = [
-        (255, 255, 255), (0, 0, 0), (255, 0, 0),
-        (255, 255, 0), (0, 255, 0), (0, 0, 255)
-    ]
-    def closest(c):
-        return min(palette, key=lambda p: sum((x - y) ** 2 for x, y in zip(c, p)))
-    rgb = image.convert("RGB")
-    result = Image.new("RGB", image.size)
-    for y in range(image.height):
-        for x in range(image.width):
-            result.putpixel((x, y), closest(rgb.getpixel((x, y))))
-    return result
-
-def main():
+    digest = hashlib.sha256()
+    image = decode_png(r.iter_content(DECODE_CHUNK), digest, out)
+    validators = {
+        "request": request_key,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "sha256": digest.hexdigest(),
+    }
+    # WMS responses often carry no validators, so fall back to the body hash
+    if validators["sha256"] == previous.get("sha256"):
+        return None, validators
+    return image, validators
+
+def decode_png(chunks, digest=None, out=None):
+    """Decode an image from a download's byte chunks into RGBA.
+
+    `digest`, a hashlib object, is fed every chunk. PIL's parser keeps the
+    whole encoded body for a PNG and decodes it at the end, but that is small
+    next to the pixels. What bounds memory is `out`: an (H, W, 4) uint8 array
+    of the image's size that the pixels land in (palette images are expanded
+    straight into it). The returned image shares its memory, so repeated
+    downloads reuse one buffer.
+    """
+    parser = ImageFile.Parser()
+    for chunk in chunks:
+        if digest is not None:
+            digest.update(chunk)
+        parser.feed(chunk)
+    image = parser.close()
+    if out is None or out.shape != (image.height, image.width, 4):
+        return image if image.mode == "RGBA" else image.convert("RGBA")
+    if image.mode == "P":
+        # Let PIL expand the palette (and its transparency) once, then index it
+        palette = Image.new("P", (256, 1))
+        palette.putdata(range(256))
+        palette.putpalette(image.getpalette(image.palette.mode), image.palette.mode)
+        palette.info = dict(image.info)
+        table = np.asarray(palette.convert("RGBA"))[0]
+        # In strips, as indexing widens the indices to 8 bytes a pixel; mode="clip"
+        # lets np.take write into `out` without a temporary copy
+        for y in range(0, image.height, 64):
+            strip = np.asarray(image.crop((0, y, image.width, min(y + 64, image.height))))
+            np.take(table, strip, axis=0, out=out[y:y + 64], mode="clip")
+    else:
+        np.copyto(out, np.asarray(image.convert("RGBA")))
+    return Image.frombuffer("RGBA", image.size, out, "raw", "RGBA", 0, 1)
+
+def fetch_layers(viewport, session, report, out=None):
+    """Download the radar (into `out`, if given) and base map concurrently.
+
+    Returns ((radar, validators), (base, base_indices)) once both are in.
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        radar = pool.submit(report.call, "fetch_radar", get_noaa_radar, viewport.radar_bbox,
+                            (viewport.width, viewport.height), load_state("radar"), session, None, out)
+        base = pool.submit(report.call, "fetch_basemap", load_basemap, viewport.lat, viewport.lon,
+                           viewport.zoom, session, (viewport.width, viewport.height), DITHER)
+        return radar.result(), base.result()
+
+def radar_indices(radar):
+    """Radar image to (H, W) palette indices, 255 where it is transparent."""
+    px = np.asarray(radar.convert("RGBA"))
+    indices = nearest_palette_indices(np.ascontiguousarray(px[..., :3]))
+    indices[px[..., 3] < 128] = 255
+    return indices
+
+class FrameHistory:
+    """Ring buffer of recent radar frames, stored on disk as palette indices.
+
+    Frames are keyed by valid time and stored once per distinct content, so
+    repeated frames (e.g. when NOAA has not updated) cost no extra space.
+    """
+
+    def __init__(self, directory, request, size, max_bytes, frame_size):
+        self.directory = directory
+        self.size = size
+        self.store = FrameStore(directory, *frame_size)
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.json")
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index = {}
+        # Frames for a different view or request are useless, start over
+        self.request = request
+        self.frames = index.get("frames", {}) if index.get("request") == request else {}
+        self.frames = {k: v for k, v in self.frames.items() if os.path.exists(self.store.path(v, "idx"))}
+
+    def wanted(self, now, step):
+        """Valid times of the frames the trail needs, newest first."""
+        latest = now.replace(second=0, microsecond=0)
+        latest -= timedelta(minutes=latest.minute % step)
+        return [latest - timedelta(minutes=step * i) for i in range(self.size)]
+
+    @staticmethod
+    def key(when):
+        return when.strftime("%Y%m%dT%H%M")
+
+    def __contains__(self, when):
+        return self.key(when) in self.frames
+
+    def add(self, when, radar):
+        indices = radar_indices(radar)
+        digest = hashlib.sha256(indices.tobytes()).hexdigest()[:32]
+        if not os.path.exists(self.store.path(digest, "idx")):
+            self.store.save(digest, "idx", indices)
+        self.frames[self.key(when)] = digest
+
+    def load(self, when):
+        digest = self.frames.get(self.key(when))
+        return None if digest is None else self.store.load(digest, "idx")
+
+    def save(self, keep):
+        """Forget frames not in `keep`, trim to the disk budget and write the index."""
+        keys = {self.key(when) for when in keep}
+        self.frames = {k: v for k, v in self.frames.items() if k in keys}
+        def used_bytes():
+            return sum(os.path.getsize(self.store.path(digest, "idx"))
+                       for digest in set(self.frames.values()))
+        for k in sorted(self.frames):
+            if used_bytes() <= self.max_bytes:
+                break
+            del self.frames[k]
+        used = {os.path.basename(self.store.path(digest, "idx")) for digest in self.frames.values()}
+        for name in os.listdir(self.directory):
+            if name not in used and name != "index.json":
+                os.remove(os.path.join(self.directory, name))
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump({"request": self.request, "frames": self.frames}, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+def update_trail(viewport, radar, session, now=None):
+    """Store the current radar and fetch missing past frames.
+
+    Returns the past frames' index arrays, oldest first.
+    """
+    now = now or datetime.now(timezone.utc)
+    history = FrameHistory(os.path.join(CACHE_DIR, "frames"), json.dumps(viewport.radar_bbox),
+                           TRAIL_FRAMES, TRAIL_MAX_BYTES, (viewport.width, viewport.height))
+    wanted = history.wanted(now, TRAIL_STEP)
+    history.add(wanted[0], radar)
+
+    size = (viewport.width, viewport.height)
+
+    def fetch(when):
+        # The trail is an extra: a frame that fails is left out (and retried
+        # next cycle) rather than failing the refresh
+        try:
+            return get_noaa_radar(viewport.radar_bbox, size, None, session, when)[0]
+        except Exception as e:
+            print(f"Skipping trail frame {when:%H:%M}: {e}")
+            return None
+
+    missing = [when for when in wanted[1:] if when not in history]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for when, image in zip(missing, pool.map(fetch, missing)):
+            if image is not None:
+                history.add(when, image)
+    history.save(wanted)
+    return [frame for frame in map(history.load, reversed(wanted[1:])) if frame is not None]
+
+def trail_layer(frames, color=TRAIL_COLOR):
+    """RGBA layer with the outline of the echoes in each past frame."""
+    layer = np.zeros(frames[0].shape + (4,), np.uint8)
+    for indices in frames:
+        mask = indices != 255
+        inner = mask.copy()
+        inner[1:] &= mask[:-1]
+        inner[:-1] &= mask[1:]
+        inner[:, 1:] &= mask[:, :-1]
+        inner[:, :-1] &= mask[:, 1:]
+        layer[mask & ~inner] = color
+    return Image.fromarray(layer, "RGBA")
+
+def reflectivity_lut(legend=REFLECTIVITY_LEGEND):
+    """24-bit RGB -> index of the nearest legend color, as a flat uint8 array.
+
+    Building it covers all 16M colors: about a second on a desktop, far
+    longer on a Pi Zero, and 16 MB plus a few MB of working memory. It is
+    built once, at startup, and kept in CACHE_DIR keyed by the legend; later
+    runs memory-map it.
+    """
+    key = hashlib.sha256(json.dumps(legend).encode()).hexdigest()[:16]
+    path = os.path.join(CACHE_DIR, f"reflectivity_{key}.npy")
+    if not os.path.exists(path):
+        colors = np.array([color for _, color in legend], dtype=np.int32)
+        norms = (colors * colors).sum(axis=1, dtype=np.int32)
+        lut = np.empty(1 << 24, dtype=np.uint8)
+        # Small chunks, all int32 (distances fit easily), to keep the
+        # temporaries to a few MB
+        step = 1 << 15
+        for start in range(0, 1 << 24, step):
+            rgb = np.arange(start, start + step, dtype=np.int32)
+            rgb = np.stack([rgb >> 16, (rgb >> 8) & 255, rgb & 255], axis=1)
+            dist = rgb @ (-2 * colors.T)
+            dist += norms
+            dist += (rgb * rgb).sum(axis=1, dtype=np.int32)[:, None]
+            lut[start:start + step] = dist.argmin(axis=1)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, lut)
+        os.replace(tmp, path)
+    return np.load(path, mmap_mode="r")
+
+def severity_table(legend=REFLECTIVITY_LEGEND, bands=SEVERITY_BANDS):
+    """Legend index -> RGBA panel color of its band (transparent below the first)."""
+    table = np.zeros((256, 4), dtype=np.uint8)
+    for i, (dbz, _) in enumerate(legend):
+        colors = [color for min_dbz, color in sorted(bands) if dbz >= min_dbz]
+        if colors:
+            table[i] = tuple(colors[-1]) + (255,)
+    return table
+
+def severity_layer(radar, lut=None, table=None):
+    """RGBA layer with each radar pixel in the solid color of its severity band."""
+    lut = reflectivity_lut() if lut is None else lut
+    table = severity_table() if table is None else table
+    px = np.asarray(radar.convert("RGBA"))
+    rgb = px[..., 0].astype(np.int32) << 16 | px[..., 1].astype(np.int32) << 8 | px[..., 2]
+    classes = lut[rgb]
+    classes[px[..., 3] < 128] = 255
+    return Image.fromarray(table[classes], "RGBA")
+
+class Compositor:
+    """Blends RGBA layers over an opaque base map in a single pass.
+
+    The work buffers, the annotation overlay and the radar download buffer
+    are allocated once and reused for every frame. render() also keeps the
+    last frame's inputs and palette indices, so the next frame only redoes
+    the tiles that changed.
+    """
+
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.overlay = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        self.radar = np.empty((height, width, 4), np.uint8)  # radar download target
+        self._acc = np.empty((height, width, 3), np.uint16)
+        self._tmp = np.empty((height, width, 3), np.uint16)
+        self._alpha = np.empty((height, width, 1), np.uint16)
+        self._out = np.empty((height, width, 3), np.uint8)
+        self._inputs = None
+        self._key = None
+        self._indices = None
+        self.dirty = 0  # pixels re-rendered by the last render()
+
+    def clear_overlay(self):
+        self.overlay.paste((0, 0, 0, 0), (0, 0, self.width, self.height))
+        return self.overlay
+
+    def composite(self, base, layers, boxes=None):
+        """Blend `layers`, a list of (RGBA image, opacity), over `base`.
+
+        With `boxes`, a list of (x0, y0, x1, y1), only those areas are
+        recomposited and the rest of the previous frame is kept. Returns an
+        (H, W, 3) uint8 array, valid until the next call.
+        """
+        acc = self._acc
+        base = np.asarray(base)
+        if boxes is None:
+            boxes = [(0, 0, self.width, self.height)]
+        for x0, y0, x1, y1 in boxes:
+            np.copyto(acc[y0:y1, x0:x1], base[y0:y1, x0:x1, :3])
+        for image, opacity in layers:
+            # Only the area the layer actually covers needs blending
+            bbox = image.getchannel("A").getbbox()
+            if bbox is not None:
+                for box in boxes:
+                    self._blend(image, opacity, _intersect(bbox, box))
+        for x0, y0, x1, y1 in boxes:
+            np.copyto(self._out[y0:y1, x0:x1], acc[y0:y1, x0:x1], casting="unsafe")
+        return self._out
+
+    def _blend(self, image, opacity, box):
+        """Blend the `box` area of one layer into the accumulator."""
+        if box is None:
+            return
+        x0, y0, x1, y1 = box
+        acc = self._acc
+        px = np.asarray(image.crop(box))
+        region = acc[y0:y1, x0:x1]
+        tmp = self._tmp[y0:y1, x0:x1]
+        alpha = self._alpha[y0:y1, x0:x1]
+
+        np.copyto(alpha, px[..., 3:])
+        if opacity < 1:
+            alpha *= round(opacity * 255)
+            alpha //= 255
+        # out = (layer * a + out * (255 - a)) / 255, rounded
+        np.multiply(px[..., :3], alpha, out=tmp)
+        np.subtract(255, alpha, out=alpha)
+        region *= alpha
+        region += tmp
+        region += 127
+        region //= 255
+
+    def render(self, base, layers, dither=None, base_indices=None):
+        """Composite and quantize a frame to (H, W) palette indices.
+
+        Only the RENDER_TILE tiles where the base or a layer differs from the
+        previous call are recomposited and requantized. With `base_indices`,
+        the base map already quantized (see load_basemap), only pixels some
+        layer covers are quantized. Floyd-Steinberg spreads error across the
+        whole frame, so it always renders and quantizes in full.
+        The result is valid until the next call.
+        """
+        inputs = [np.asarray(base)] + [np.asarray(image) for image, _ in layers]
+        key = (dither, [opacity for _, opacity in layers], [a.shape for a in inputs])
+        previous, self._inputs = self._inputs, inputs
+        if previous is None or key != self._key or dither == "floyd-steinberg":
+            self._key = key
+            rgb = self.composite(base, layers)
+            if dither == "floyd-steinberg" or base_indices is None:
+                self._indices = quantize_indices(rgb, dither)
+            else:
+                self._indices = np.array(base_indices)
+                covered = layer_coverage(inputs[1:], self._indices.shape)
+                self._indices[covered] = quantize_pixels(rgb, covered, dither)
+            self.dirty = self.width * self.height
+            return self._indices
+
+        changed = np.zeros((self.height, self.width), bool)
+        for new, old in zip(inputs, previous):
+            if new.shape[2] == 4:
+                # Compare whole RGBA pixels as one 32-bit word each
+                changed |= new.view(np.uint32)[..., 0] != old.view(np.uint32)[..., 0]
+            else:
+                changed |= (new != old).any(axis=2)
+        boxes = dirty_boxes(changed, RENDER_TILE)
+        if boxes:
+            rgb = self.composite(base, layers, boxes)
+            covered = None if base_indices is None else layer_coverage(inputs[1:], self._indices.shape)
+            for x0, y0, x1, y1 in boxes:
+                target = self._indices[y0:y1, x0:x1]
+                if covered is None:
+                    target[...] = quantize_indices(rgb[y0:y1, x0:x1], dither)
+                else:
+                    mask = covered[y0:y1, x0:x1]
+                    target[...] = base_indices[y0:y1, x0:x1]
+                    target[mask] = quantize_pixels(rgb[y0:y1, x0:x1], mask, dither)
+        self.dirty = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes)
+        return self._indices
+
+def layer_coverage(layers, shape):
+    """(H, W) mask of the pixels any of the (H, W, 4) RGBA arrays draws on."""
+    covered = np.zeros(shape, bool)
+    for layer in layers:
+        covered |= layer[..., 3] > 0
+    return covered
+
+def _intersect(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    return (x0, y0, x1, y1) if x0 < x1 and y0 < y1 else None
+
+def dirty_boxes(changed, tile):
+    """Boxes covering every True pixel of `changed`, as runs of whole tiles per tile row."""
+    h, w = changed.shape
+    rows = np.logical_or.reduceat(changed, np.arange(0, h, tile), axis=0)
+    tiles = np.logical_or.reduceat(rows, np.arange(0, w, tile), axis=1)
+    boxes = []
+    for ty, row in enumerate(tiles):
+        # Edges of each run of dirty tiles in this row
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], row.view(np.int8), [0]))))
+        for start, end in zip(edges[0::2], edges[1::2]):
+            boxes.append((start * tile, ty * tile, min(end * tile, w), min((ty + 1) * tile, h)))
+    return boxes
+
+def draw_annotations(overlay, viewport, font):
+    draw = ImageDraw.Draw(overlay)
+
+    # Crosshair
+    x, y = viewport.to_pixel(viewport.lat, viewport.lon)
+    size = 10
+    draw.line([(x - size, y), (x + size, y)], fill=(255, 0, 0, 255), width=2)
+    draw.line([(x, y - size), (x, y + size)], fill=(255, 0, 0, 255), width=2)
+
+    # Timestamp
+    timestamp = datetime.now().strftime("Last updated: %Y-%m-%d %H:%M")
+    bbox = draw.textbbox((0, 0), timestamp, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    padding = 5
+    tx = padding
+    ty = overlay.height - text_height - padding
+    draw.rectangle(
+        [tx - 2, ty - 2, tx + text_width + 2, ty + text_height + 2],
+        fill=(255, 255, 255, 200)
+    )
+    draw.text((tx, ty), timestamp, font=font, fill=(255, 0, 0, 255))
+
+def nearest_palette_indices(rgb):
+    """Map an (H, W, 3) uint8 array to (H, W) indices into PALETTE."""
+    flat = rgb.reshape(-1, 3).astype(np.int32)
+    # |c - p|^2 = |c|^2 - 2 c.p + |p|^2; |c|^2 is the same for every p
+    dist = (PALETTE ** 2).sum(axis=1) - 2 * (flat @ PALETTE.T)
+    # argmin picks the first minimum, matching min() over the palette list
+    return dist.argmin(axis=1).astype(np.uint8).reshape(rgb.shape[:2])
+
+def quantize_indices(image, dither=None):
+    """Quantize an image or (H, W, 3) array to (H, W) palette indices, optionally dithered."""
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image, "RGB") if dither == "floyd-steinberg" else image
+    if dither == "floyd-steinberg":
+        pal_image = Image.new("P", (1, 1))
+        pal_image.putpalette(PALETTE.astype(np.uint8).tobytes() + bytes(3 * (256 - len(PALETTE))))
+        quantized = image.convert("RGB").quantize(palette=pal_image, dither=Image.Dither.FLOYDSTEINBERG)
+        return np.asarray(quantized, dtype=np.uint8)
+
+    rgb = image if isinstance(image, np.ndarray) else np.asarray(image.convert("RGB"))
+    if dither == "ordered":
+        threshold = bayer_threshold(*rgb.shape[:2])[..., None]
+        rgb = np.clip(rgb + threshold * ORDERED_SPREAD, 0, 255).astype(np.uint8)
+    elif dither is not None:
+        raise ValueError(f"Unknown dither mode: {dither}")
+    return nearest_palette_indices(rgb)
+
+def quantize_pixels(rgb, mask, dither=None):
+    """quantize_indices() for just the `mask` pixels of an (H, W, 3) array.
+
+    Returns a flat array, in the order of rgb[mask]. Not for Floyd-Steinberg,
+    which needs whole neighbourhoods.
+    """
+    pixels = rgb[mask][:, None]
+    if dither == "ordered":
+        threshold = bayer_threshold(*mask.shape)[mask][:, None, None]
+        pixels = np.clip(pixels + threshold * ORDERED_SPREAD, 0, 255).astype(np.uint8)
+    elif dither is not None:
+        raise ValueError(f"Unknown dither mode: {dither}")
+    return nearest_palette_indices(pixels)[:, 0]
+
+def bayer_threshold(h, w):
+    """BAYER_4X4 tiled over an h x w area."""
+    return np.tile(BAYER_4X4, (h // 4 + 1, w // 4 + 1))[:h, :w]
+
+def pack_indices(indices):
+    """Pack (H, W) palette indices into the panel's 4-bit buffer."""
+    if indices.shape == (WIDTH, HEIGHT):
+        indices = np.rot90(indices)
+    codes = PANEL_CODES[indices].reshape(-1)
+    # Two pixels per byte, left pixel in the high nibble
+    return bytearray((codes[0::2] << 4) | codes[1::2])
+
+def make_epd():
+    epd = epd7in3e.EPD()
+    epd.busy_timeout = EPD_BUSY_TIMEOUT
+    return epd
+
+def load_font():
+    return ImageFont.truetype(FONT_PATH, 14)
+
+def default_viewport():
+    return Viewport(LAT, LON, ZOOM, WIDTH, HEIGHT, RADAR_SCALE, (RADAR_OFFSET_X, RADAR_OFFSET_Y))
+
+def with_report(cycle, *args):
+    """Run one refresh cycle, recording a RunReport for it."""
+    report = RunReport()
     try:
-        print("Getting map bounds...")
-        bounds = get_map_bounds_from_zoom(LAT, LON, ZOOM, WIDTH, HEIGHT)
-
-        print("Downloading base map...")
-        base = get_static_map(LAT, LON, ZOOM)
-
-        print("Downloading NOAA radar...")
-        radar = get_noaa_radar(bounds)
-
-        print("Adjusting radar position/scale...")
-        radar = adjust_radar(radar)  # <-- new step
-
-        print("Reducing radar opacity...")
-        radar = reduce_opacity(radar, 0.7)
-
-        # Create overlay for crosshair + timestamp
-        overlay = Image.new("RGBA", base.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(overlay)
-
-        # Crosshair
-        x, y = latlon_to_pixel(LAT, LON, bounds, base.size)
-        size = 10
-        draw.line([(x - size, y), (x + size, y)], fill=(255, 0, 0, 255), width=2)
-        draw.line([(x, y - size), (x, y + size)], fill=(255, 0, 0, 255), width=2)
-
-        # Timestamp
-        timestamp = datetime.now().strftime("Last updated: %Y-%m-%d %H:%M")
-        font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 14)
-        bbox = draw.textbbox((0, 0), timestamp, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        padding = 5
-        tx = padding
-        ty = overlay.height - text_height - padding
-        draw.rectangle(
-            [tx - 2, ty - 2, tx + text_width + 2, ty + text_height + 2],
-            fill=(255, 255, 255, 200)
-        )
-        draw.text((tx, ty), timestamp, font=font, fill=(255, 0, 0, 255))
-
-        # Composite base + radar + overlay
-        combined = Image.alpha_composite(base, radar)
-        combined = Image.alpha_composite(combined, overlay)
-
-        print("Preparing for EPD...")
-        epd_ready = prepare_for_epd(combined)
-
-        print("Initializing ePaper...")
-        epd = epd7in3e.EPD()
-        epd.init()
-        epd.Clear()
+        report.status = cycle(report, *args)
+    except Exception:
+        report.fail()
+        raise
+    finally:
+        report.save()
+
+def refresh(sinks, font, session, viewport, compositor):
+    """Run one fetch and render cycle, sending the frame to each of `sinks`."""
+    with_report(_refresh, sinks, font, session, viewport, compositor)
+
+def frame_layers(viewport, radar, font, compositor, trail=None):
+    """The (RGBA image, opacity) layers drawn over the base map."""
+    overlay = compositor.clear_overlay()
+    draw_annotations(overlay, viewport, font)
+    if SEVERITY_COLORS:
+        layers = [(severity_layer(radar), 1.0), (overlay, 1.0)]
+    else:
+        layers = [(radar, RADAR_OPACITY), (overlay, 1.0)]
+    if trail:
+        layers.insert(0, (trail_layer(trail), 1.0))
+    return layers
+
+def show_on_epd(epd, buf, report, store):
+    """Display a packed frame unless it barely differs from the last one shown."""
+    last = store.load("displayed", "bin")
+    if last is not None and len(last) == len(buf):
+        changed = changed_pixels(buf, last)
+        if changed < MIN_CHANGED_PIXELS:
+            print(f"Only {changed} pixels changed, skipping panel refresh.")
+            return "skipped"
+
+    print("Initializing ePaper...")
+    epdconfig.spi_stats.reset()
+    epd.busy_waits.clear()
+    try:
+        with report.stage("epd_init"):
+            epd.init()
+        if CLEAR_BEFORE_DISPLAY:
+            with report.stage("epd_clear"):
+                epd.Clear()
 
         print("Displaying image...")
-        buf = epd.getbuffer(epd_ready)
-        epd.display(buf)
-        epd.sleep()
-        print("Done.")
+        with report.stage("epd_display"):
+            epd.display(buf)
+    finally:
+        with report.stage("epd_sleep"):
+            epd.sleep()
+        stats = epdconfig.spi_stats
+        report.record("spi_transfer", stats.seconds, bytes=stats.bytes, transfers=stats.transfers)
+        phases = {}
+        for phase, seconds in epd.busy_waits:
+            phases[phase] = round(phases.get(phase, 0) + seconds, 3)
+        report.record("busy_wait", sum(phases.values()), phases=phases)
+    store.save("displayed", "bin", buf)
+    print(f"SPI: {stats.bytes} bytes in {stats.seconds:.2f}s ({stats.throughput / 1024:.0f} KiB/s)")
+    return "displayed"
+
+class Frame:
+    """One rendered frame, as (H, W) palette indices.
+
+    The packed panel buffer and the preview image are each worked out once,
+    on first use, however many outputs ask for them.
+    """
+
+    def __init__(self, indices):
+        self.indices = indices
+        self._packed = None
+        self._preview = None
+
+    @property
+    def packed(self):
+        if self._packed is None:
+            self._packed = pack_indices(self.indices)
+        return self._packed
+
+    @property
+    def preview(self):
+        if self._preview is None:
+            self._preview = Image.fromarray(PALETTE.astype(np.uint8)[self.indices], "RGB")
+        return self._preview
+
+class EpdSink:
+    """Shows frames on the panel, skipping ones that barely changed."""
+
+    kind = "epd"
+
+    def __init__(self, epd, store):
+        self.epd = epd
+        self.store = store
+
+    def write(self, frame, report):
+        return show_on_epd(self.epd, frame.packed, report, self.store)
+
+class PngSink:
+    """Saves a preview PNG of the frame in the panel's colors."""
+
+    kind = "png"
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, frame, report=None):
+        frame.preview.save(self.path + ".tmp", "PNG")
+        os.replace(self.path + ".tmp", self.path)
+        return "written"
+
+class RawSink:
+    """Saves the packed 4-bit panel buffer, exactly as the panel would get it."""
+
+    kind = "raw"
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, frame, report=None):
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(frame.packed)
+        os.replace(self.path + ".tmp", self.path)
+        return "written"
+
+def parse_output(spec):
+    """Split an output spec ("epd", "png:<path>" or "raw:<path>") into (kind, path)."""
+    kind, _, path = spec.partition(":")
+    if not (spec == "epd" or (kind in ("png", "raw") and path)):
+        raise ValueError(f"Unknown output: {spec}")
+    return kind, path
+
+def make_sink(spec, viewport, epd=None):
+    """The sink for an output spec; the panel is only set up if it is used."""
+    kind, path = parse_output(spec)
+    if kind == "epd":
+        return EpdSink(epd or make_epd(), frame_store(viewport))
+    return PngSink(path) if kind == "png" else RawSink(path)
+
+def write_frame(frame, sinks, report=None):
+    """Send a frame to every sink; returns the panel's status, else "rendered".
+
+    With a report, packing is timed as "pack" and each write as "output_<kind>".
+    """
+    def stage(name):
+        return report.stage(name) if report else nullcontext()
+
+    if any(sink.kind != "png" for sink in sinks):
+        with stage("pack"):
+            frame.packed
+    status = "rendered"
+    for sink in sinks:
+        with stage(f"output_{sink.kind}"):
+            result = sink.write(frame, report)
+        if sink.kind == "epd":
+            status = result
+    return status
+
+def _refresh(report, sinks, font, session, viewport, compositor):
+    print("Downloading NOAA radar and base map...")
+    with report.stage("fetch"):
+        (radar, validators), (base, base_indices) = fetch_layers(viewport, session, report, compositor.radar)
+    if radar is None:
+        print("Radar unchanged since last refresh, no change.")
+        return "unchanged"
+
+    trail = None
+    if TRAIL_FRAMES:
+        print("Updating radar trail...")
+        with report.stage("fetch_trail"):
+            trail = update_trail(viewport, radar, session)
+
+    print("Compositing...")
+    with report.stage("composite"):
+        layers = frame_layers(viewport, radar, font, compositor, trail)
+        indices = compositor.render(base, layers, DITHER, base_indices)
+    report.stages["composite"]["dirty_pixels"] = compositor.dirty
+
+    status = write_frame(Frame(indices), sinks, report)
+    save_state("radar", validators)
+    print("Done.")
+    return status
+
+Site = namedtuple("Site", "name viewport outputs")
+
+def load_sites(path):
+    """Read the --config file: a JSON list of sites.
+
+    Each site has "name", "lat", "lon" and "output" ("epd" for the local
+    panel, "png:<path>" for a preview image or "raw:<path>" for the packed
+    panel buffer, or a list of these), and optionally "zoom", "width",
+    "height", "radar_scale" and "radar_offset" (defaulting to the settings
+    above).
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    sites = []
+    for entry in entries:
+        viewport = Viewport(entry["lat"], entry["lon"], entry.get("zoom", ZOOM),
+                            entry.get("width", WIDTH), entry.get("height", HEIGHT),
+                            entry.get("radar_scale", RADAR_SCALE),
+                            tuple(entry.get("radar_offset", (RADAR_OFFSET_X, RADAR_OFFSET_Y))))
+        outputs = entry["output"]
+        outputs = tuple([outputs] if isinstance(outputs, str) else outputs)
+        for spec in outputs:
+            try:
+                parse_output(spec)
+            except ValueError:
+                raise ValueError(f"Unknown output for site {entry['name']}: {spec}") from None
+        sites.append(Site(entry["name"], viewport, outputs))
+    if sum(site.outputs.count("epd") for site in sites) > 1:
+        raise ValueError("Only one site can use the local panel")
+    return sites
+
+def covering_radar_request(viewports):
+    """EPSG:3857 bbox and pixel size of one radar image covering every viewport."""
+    # Keep the finest resolution any viewport needs, within MULTI_MAX_SIZE
+    mpp = min((vp.radar_bbox[2] - vp.radar_bbox[0]) / vp.width for vp in viewports)
+    min_x = min(vp.radar_bbox[0] for vp in viewports)
+    min_y = min(vp.radar_bbox[1] for vp in viewports)
+    max_x = max(vp.radar_bbox[2] for vp in viewports)
+    max_y = max(vp.radar_bbox[3] for vp in viewports)
+    width, height = (max_x - min_x) / mpp, (max_y - min_y) / mpp
+    shrink = max(1, max(width, height) / MULTI_MAX_SIZE)
+    return (min_x, min_y, max_x, max_y), (max(1, round(width / shrink)), max(1, round(height / shrink)))
+
+def crop_radar(cover, cover_bbox, viewport):
+    """Cut one viewport's radar out of a covering image (in premultiplied RGBa)."""
+    min_x, min_y, max_x, max_y = cover_bbox
+    sx = cover.width / (max_x - min_x)
+    sy = cover.height / (max_y - min_y)
+    x0, y0, x1, y1 = viewport.radar_bbox
+    box = ((x0 - min_x) * sx, (max_y - y1) * sy, (x1 - min_x) * sx, (max_y - y0) * sy)
+    return cover.transform((viewport.width, viewport.height), Image.EXTENT, box, Image.BILINEAR).convert("RGBA")
+
+def render_site(site, radar):
+    """Worker process: render one site and write its file outputs.
+
+    Returns the frame's palette indices if the site is shown on the panel.
+    """
+    viewport = site.viewport
+    base, base_indices = load_basemap(viewport.lat, viewport.lon, viewport.zoom,
+                                      size=(viewport.width, viewport.height), dither=DITHER)
+    compositor = Compositor(viewport.width, viewport.height)
+    indices = compositor.render(base, frame_layers(viewport, radar, load_font(), compositor),
+                                DITHER, base_indices)
+    write_frame(Frame(indices), [make_sink(spec, viewport) for spec in site.outputs if spec != "epd"])
+    return indices if "epd" in site.outputs else None
+
+def refresh_sites(epd, session, sites):
+    """Run one cycle for every site from a single radar download."""
+    with_report(_refresh_sites, epd, session, sites)
+
+def _refresh_sites(report, epd, session, sites):
+    print(f"Downloading NOAA radar for {len(sites)} sites...")
+    bbox, size = covering_radar_request([site.viewport for site in sites])
+    with report.stage("fetch_radar"):
+        radar, validators = get_noaa_radar(bbox, size, load_state("radar_sites"), session)
+    if radar is None:
+        print("Radar unchanged since last refresh, no change.")
+        return "unchanged"
+
+    # Download or refresh the base maps here, on the shared session, so the
+    # workers only memory-map the cached arrays
+    with report.stage("fetch_basemaps"):
+        for site in sites:
+            viewport = site.viewport
+            load_basemap(viewport.lat, viewport.lon, viewport.zoom, session,
+                         (viewport.width, viewport.height), DITHER)
+
+    print("Rendering sites...")
+    with report.stage("render_sites"):
+        cover = radar.convert("RGBa")
+        crops = [crop_radar(cover, bbox, site.viewport) for site in sites]
+        if SEVERITY_COLORS:
+            reflectivity_lut()  # build it once here rather than in every worker
+        with ProcessPoolExecutor(max_workers=min(len(sites), os.cpu_count() or 1)) as pool:
+            rendered = list(pool.map(render_site, sites, crops))
+
+    status = "rendered"
+    for site, indices in zip(sites, rendered):
+        if indices is not None:
+            status = write_frame(Frame(indices), [make_sink("epd", site.viewport, epd)], report)
+    save_state("radar_sites", validators)
+    print("Done.")
+    return status
+
+def replay(directory, out_dir=None, workers=None):
+    """Render every radar PNG in `directory` offline and return frames per second.
+
+    Frames must cover the base map's own extent (no RADAR_SCALE or offset);
+    the fine-tune and color settings are applied here as they would be live,
+    so they can be tried out without waiting on NOAA or the panel. The base
+    map is basemap.png in `directory` if there is one, else the cached map.
+    Writes a <name>.png preview and a <name>.WxH.bin panel buffer per frame
+    to `out_dir` (default: <directory>/replay).
+    """
+    out_dir = out_dir or os.path.join(directory, "replay")
+    os.makedirs(out_dir, exist_ok=True)
+    frames = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                    if name.endswith(".png") and name != "basemap.png")
+    viewport = default_viewport()
+    basemap = os.path.join(directory, "basemap.png")
+    if os.path.exists(basemap):
+        base = np.asarray(Image.open(basemap).convert("RGBA"))
+        base_indices = quantize_indices(np.ascontiguousarray(base[..., :3]), DITHER)
+    else:
+        base, base_indices = load_basemap(viewport.lat, viewport.lon, viewport.zoom, make_session(),
+                                          (viewport.width, viewport.height), DITHER)
+        base, base_indices = np.array(base), np.array(base_indices)
+    if SEVERITY_COLORS:
+        reflectivity_lut()  # build it once here rather than in every worker
+
+    workers = workers or os.cpu_count() or 1
+    print(f"Replaying {len(frames)} frames on {workers} workers...")
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_start_replay,
+                             initargs=(viewport, base, base_indices, out_dir)) as pool:
+        # Consecutive frames go to the same worker, whose Compositor then
+        # only redraws what changed between them
+        list(pool.map(replay_frame, frames, chunksize=max(1, len(frames) // (workers * 4))))
+    seconds = time.perf_counter() - start
+    fps = len(frames) / seconds
+    print(f"Rendered {len(frames)} frames in {seconds:.1f}s ({fps:.1f} frames/s) to {out_dir}")
+    return fps
+
+_replay = {}
+
+def _start_replay(viewport, base, base_indices, out_dir):
+    _replay.update(
+        viewport=viewport, base=base, base_indices=base_indices, font=load_font(),
+        compositor=Compositor(viewport.width, viewport.height), out_dir=out_dir,
+        store=FrameStore(out_dir, viewport.width, viewport.height),
+        cover_bbox=Viewport(viewport.lat, viewport.lon, viewport.zoom, viewport.width, viewport.height).radar_bbox,
+    )
+
+def replay_frame(path):
+    """Worker process: render one recorded radar frame and write its outputs."""
+    viewport, compositor = _replay["viewport"], _replay["compositor"]
+    with Image.open(path) as image:
+        if image.size != (viewport.width, viewport.height):
+            raise ValueError(f"{path}: {image.width}x{image.height}, expected {viewport.width}x{viewport.height}")
+        radar = crop_radar(image.convert("RGBA").convert("RGBa"), _replay["cover_bbox"], viewport)
+    layers = frame_layers(viewport, radar, _replay["font"], compositor)
+    indices = compositor.render(_replay["base"], layers, DITHER, _replay["base_indices"])
+    name = os.path.splitext(os.path.basename(path))[0]
+    frame = Frame(indices)
+    frame.preview.save(os.path.join(_replay["out_dir"], name + ".png"))
+    _replay["store"].save(name, "bin", frame.packed)
+
+def next_run(now, interval, offset):
+    return (now - offset) // interval * interval + interval + offset
+
+def run_daemon(interval=DAEMON_INTERVAL, offset=DAEMON_OFFSET, sites=None, outputs=("epd",)):
+    """Refresh on a fixed schedule, keeping the session, font and outputs alive."""
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: stop.set())
+    sys.stdout.reconfigure(line_buffering=True)
+
+    session = make_session()
+    font = load_font()
+    viewport = default_viewport()
+    if SEVERITY_COLORS:
+        reflectivity_lut()  # build it before the first refresh, not during it
+    if sites:
+        epd = make_epd() if any("epd" in site.outputs for site in sites) else None
+    else:
+        sinks = [make_sink(spec, viewport) for spec in outputs]
+    compositor = Compositor(viewport.width, viewport.height)
+    print(f"Daemon started, refreshing every {interval}s")
+    while not stop.is_set():
+        try:
+            if sites:
+                refresh_sites(epd, session, sites)
+            else:
+                refresh(sinks, font, session, viewport, compositor)
+        except Exception as e:
+            print(f"Error: {e}")
+        stop.wait(next_run(time.time(), interval, offset) - time.time())
+    # refresh() always leaves the panel asleep, even when it fails
+    print("Stopped.")
+
+def changed_pixels(buf, previous):
+    """Count pixels that differ between two packed 4-bit panel buffers."""
+    diff = np.frombuffer(buf, np.uint8) ^ np.frombuffer(previous, np.uint8)
+    return int(np.count_nonzero(diff & 0xF0) + np.count_nonzero(diff & 0x0F))
+
+def main(sites=None, outputs=("epd",)):
+    try:
+        if SEVERITY_COLORS:
+            reflectivity_lut()
+        if sites:
+            epd = make_epd() if any("epd" in site.outputs for site in sites) else None
+            refresh_sites(epd, make_session(), sites)
+            return
+        viewport = default_viewport()
+        refresh([make_sink(spec, viewport) for spec in outputs], load_font(), make_session(), viewport,
+                Compositor(viewport.width, viewport.height))
     except Exception as e:
         print(f"Error: {e}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Weather radar on a Waveshare 7.3in e-Paper display")
+    parser.add_argument("--daemon", action="store_true", help="keep running and refresh on a schedule")
+    parser.add_argument("--interval", type=int, default=DAEMON_INTERVAL, help="seconds between refreshes in daemon mode")
+    parser.add_argument("--offset", type=int, default=DAEMON_OFFSET, help="seconds past each interval boundary to refresh at")
+    parser.add_argument("--backend", help="EPD backend: raspberrypi, jetson, sunrise, null or file:<path> "
+                                          "(default: $EPD_BACKEND, else detect the board)")
+    parser.add_argument("--config", help="JSON list of sites to render from one radar download (see load_sites)")
+    parser.add_argument("--output", action="append", metavar="SPEC",
+                        help="where to send the frame: epd, png:<path> or raw:<path>; "
+                             "repeat to send it to several (default: epd; sites set their own)")
+    parser.add_argument("--replay", metavar="DIR", help="render the radar PNGs in DIR offline and exit (see replay)")
+    parser.add_argument("--out", metavar="DIR", help="where --replay writes previews and panel buffers (default: DIR/replay)")
+    parser.add_argument("--workers", type=int, help="--replay worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    if args.backend:
+        epdconfig.use_backend(args.backend)
+    sites = load_sites(args.config) if args.config else None
+    outputs = args.output or ["epd"]
+    for spec in outputs:
+        try:
+            parse_output(spec)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.replay:
+        replay(args.replay, args.out, args.workers)
+    elif args.daemon:
+        run_daemon(args.interval, args.offset, sites, outputs)
+    else:
+        main(sites, outputs)
@@ -34,6 +34,7 @@ from . import epdconfig
 import PIL
 from PIL import Image
 import io
+import time
 
 # Display resolution
 EPD_WIDTH = 800
@@ -41,6 +42,42 @@ EPD_HEIGHT = 480
 
 logger = logging.getLogger(__name__)
 
+BUSY_TIMEOUT = 60  # seconds; a full refresh normally takes 15-20
+BUSY_POLL_MAX_MS = 100
+
+
+class BusyTimeoutError(TimeoutError):
+    pass
+
+
+# Command sequences as (command, data bytes, BUSY phase to wait for or None)
+INIT_SEQUENCE = (
+    (0xAA, (0x49, 0x55, 0x20, 0x08, 0x09, 0x18), None),
+    (0x01, (0x3F,), None),
+    (0x00, (0x5F, 0x69), None),
+    (0x03, (0x00, 0x54, 0x00, 0x44), None),
+    (0x05, (0x40, 0x1F, 0x1F, 0x2C), None),
+    (0x06, (0x6F, 0x1F, 0x17, 0x49), None),
+    (0x08, (0x6F, 0x1F, 0x1F, 0x22), None),
+    (0x30, (0x03,), None),
+    (0x50, (0x3F,), None),
+    (0x60, (0x02, 0x00), None),
+    (0x61, (0x03, 0x20, 0x01, 0xE0), None),
+    (0x84, (0x01,), None),
+    (0xE3, (0x2F,), None),
+    (0x04, (), 'init_power_on'),
+)
+
+TURN_ON_SEQUENCE = (
+    (0x04, (), 'power_on'),            # POWER_ON
+    (0x12, (0x00,), 'display_refresh'),  # DISPLAY_REFRESH
+    (0x02, (0x00,), 'power_off'),      # POWER_OFF
+)
+
+SLEEP_SEQUENCE = (
+    (0x07, (0xA5,), None),  # DEEP_SLEEP
+)
+
 
 class EPD:
     def __init__(self):
@@ -57,6 +94,10 @@ class EPD:
         # self.ORANGE = 0x0080ff   #   0100
         self.BLUE = 0xff0000  # 0101
         self.GREEN = 0x00ff00  # 0110
+        self._clear_color = None
+        self._clear_buf = None
+        self.busy_timeout = BUSY_TIMEOUT
+        self.busy_waits = []  # (phase, seconds) for each ReadBusyH call
 
     # Hardware reset
     def reset(self):
@@ -86,95 +127,57 @@ class EPD:
         epdconfig.spi_writebyte2(data)
         epdconfig.digital_write(self.cs_pin, 1)
 
-    def ReadBusyH(self):
-        logger.debug("e-Paper busy H")
-        while (epdconfig.digital_read(self.busy_pin) == 0):  # 0: busy, 1: idle
-            epdconfig.delay_ms(5)
-        logger.debug("e-Paper busy H release")
-
-    def TurnOnDisplay(self):
-        self.send_command(0x04)  # POWER_ON
-        self.ReadBusyH()
+    # command plus all of its data with a single DC transition and SPI write
+    def send_command_data(self, command, data=()):
+        epdconfig.digital_write(self.dc_pin, 0)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte([command])
+        if len(data):
+            epdconfig.digital_write(self.dc_pin, 1)
+            epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
 
-        self.send_command(0x12)  # DISPLAY_REFRESH
-        self.send_data(0X00)
-        self.ReadBusyH()
+    def send_sequence(self, sequence):
+        for command, data, busy_phase in sequence:
+            self.send_command_data(command, bytes(data))
+            if busy_phase:
+                self.ReadBusyH(busy_phase)
+
+    def ReadBusyH(self, phase='busy'):
+        logger.debug("e-Paper busy H (%s)", phase)
+        start = time.monotonic()
+        wait = getattr(epdconfig, 'digital_wait', None)
+        if wait is not None:
+            idle = wait(self.busy_pin, 1, self.busy_timeout)
+        else:
+            # No edge events on this backend: poll with a backoff from 1 ms
+            # up to BUSY_POLL_MAX_MS, since most waits are either very short
+            # or a whole refresh
+            delay = 1
+            while epdconfig.digital_read(self.busy_pin) == 0:  # 0: busy, 1: idle
+                if time.monotonic() - start > self.busy_timeout:
+                    break
+                epdconfig.delay_ms(delay)
+                delay = min(delay * 2, BUSY_POLL_MAX_MS)
+            idle = epdconfig.digital_read(self.busy_pin) != 0
+        elapsed = time.monotonic() - start
+        self.busy_waits.append((phase, elapsed))
+        if not idle:
+            raise BusyTimeoutError("e-Paper still busy after %.1fs (%s)" % (elapsed, phase))
+        logger.debug("e-Paper busy H release after %.3fs", elapsed)
 
-        self.send_command(0x02)  # POWER_OFF
-        self.send_data(0X00)
-        self.ReadBusyH()
+    def TurnOnDisplay(self):
+        self.send_sequence(TURN_ON_SEQUENCE)
 
     def init(self):
         if (epdconfig.module_init() != 0):
             return -1
         # EPD hardware init start
         self.reset()
-        self.ReadBusyH()
+        self.ReadBusyH('reset')
         epdconfig.delay_ms(30)
 
-        self.send_command(0xAA)
-        self.send_data(0x49)
-        self.send_data(0x55)
-        self.send_data(0x20)
-        self.send_data(0x08)
-        self.send_data(0x09)
-        self.send_data(0x18)
-
-        self.send_command(0x01)
-        self.send_data(0x3F)
-
-        self.send_command(0x00)
-        self.send_data(0x5F)
-        self.send_data(0x69)
-
-        self.send_command(0x03)
-        self.send_data(0x00)
-        self.send_data(0x54)
-        self.send_data(0x00)
-        self.send_data(0x44)
-
-        self.send_command(0x05)
-        self.send_data(0x40)
-        self.send_data(0x1F)
-        self.send_data(0x1F)
-        self.send_data(0x2C)
-
-        self.send_command(0x06)
-        self.send_data(0x6F)
-        self.send_data(0x1F)
-        self.send_data(0x17)
-        self.send_data(0x49)
-
-        self.send_command(0x08)
-        self.send_data(0x6F)
-        self.send_data(0x1F)
-        self.send_data(0x1F)
-        self.send_data(0x22)
-
-        self.send_command(0x30)
-        self.send_data(0x03)
-
-        self.send_command(0x50)
-        self.send_data(0x3F)
-
-        self.send_command(0x60)
-        self.send_data(0x02)
-        self.send_data(0x00)
-
-        self.send_command(0x61)
-        self.send_data(0x03)
-        self.send_data(0x20)
-        self.send_data(0x01)
-        self.send_data(0xE0)
-
-        self.send_command(0x84)
-        self.send_data(0x01)
-
-        self.send_command(0xE3)
-        self.send_data(0x2F)
-
-        self.send_command(0x04)
-        self.ReadBusyH()
+        self.send_sequence(INIT_SEQUENCE)
         return 0
 
     def getbuffer(self, image):
@@ -200,7 +203,7 @@ class EPD:
 
         # PIL does not support 4 bit color, so pack the 4 bits of color
         # into a single byte to transfer to the panel
-        buf = [0x00] * int(self.width * self.height / 2)
+        buf = bytearray(int(self.width * self.height / 2))
         idx = 0
         for i in range(0, len(buf_7color), 2):
             buf[idx] = (buf_7color[i] << 4) + buf_7color[i + 1]
@@ -208,21 +211,23 @@ class EPD:
 
         return buf
 
+    # image: packed buffer from getbuffer, as a list or any bytes-like object
     def display(self, image):
-        self.send_command(0x10)
-        self.send_data2(image)
+        self.send_command_data(0x10, image)
 
         self.TurnOnDisplay()
 
     def Clear(self, color=0x11):
-        self.send_command(0x10)
-        self.send_data2([color] * int(self.height) * int(self.width / 2))
+        # Reuse the fill buffer between clears instead of rebuilding it
+        if self._clear_color != color:
+            self._clear_buf = bytes([color]) * (int(self.height) * int(self.width / 2))
+            self._clear_color = color
+        self.send_command_data(0x10, self._clear_buf)
 
         self.TurnOnDisplay()
 
     def sleep(self):
-        self.send_command(0x07)  # DEEP_SLEEP
-        self.send_data(0XA5)
+        self.send_sequence(SLEEP_SEQUENCE)
 
         epdconfig.delay_ms(2000)
         epdconfig.module_exit()
@@ -31,12 +31,54 @@ import os
 import logging
 import sys
 import time
-import subprocess
 
 from ctypes import *
 
 logger = logging.getLogger(__name__)
 
+SPIDEV_BUFSIZ = '/sys/module/spidev/parameters/bufsiz'
+
+
+def spi_chunk_size():
+    # spidev rejects single transfers larger than its bufsiz parameter
+    try:
+        with open(SPIDEV_BUFSIZ) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 4096
+
+
+def iter_chunks(data, size):
+    if isinstance(data, (list, tuple)):
+        data = bytes(data)
+    view = memoryview(data).cast('B')
+    for start in range(0, len(view), size):
+        yield view[start:start + size]
+
+
+class SPIStats:
+    """Running count of bytes sent over SPI and time spent sending them."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bytes = 0
+        self.transfers = 0
+        self.seconds = 0.0
+
+    def add(self, nbytes, seconds):
+        self.bytes += nbytes
+        self.transfers += 1
+        self.seconds += seconds
+
+    @property
+    def throughput(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+spi_stats = SPIStats()
+
 
 class RaspberryPi:
     # Pin definition
@@ -53,6 +95,7 @@ class RaspberryPi:
         import gpiozero
 
         self.SPI = spidev.SpiDev()
+        self.chunk_size = spi_chunk_size()
         self.GPIO_RST_PIN = gpiozero.LED(self.RST_PIN)
         self.GPIO_DC_PIN = gpiozero.LED(self.DC_PIN)
         # self.GPIO_CS_PIN     = gpiozero.LED(self.CS_PIN)
@@ -93,6 +136,15 @@ class RaspberryPi:
         elif pin == self.PWR_PIN:
             return self.PWR_PIN.value
 
+    def digital_wait(self, pin, value, timeout=None):
+        # Sleep on gpiozero's edge events rather than polling the pin;
+        # returns False if the timeout expires first
+        if pin != self.BUSY_PIN:
+            raise ValueError('Can only wait on the BUSY pin')
+        if value:
+            return self.GPIO_BUSY_PIN.wait_for_active(timeout)
+        return self.GPIO_BUSY_PIN.wait_for_inactive(timeout)
+
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
@@ -100,7 +152,8 @@ class RaspberryPi:
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
-        self.SPI.writebytes2(data)
+        for chunk in iter_chunks(data, self.chunk_size):
+            self.SPI.writebytes2(chunk)
 
     def DEV_SPI_write(self, data):
         self.DEV_SPI.DEV_SPI_SendData(data)
@@ -184,6 +237,10 @@ class JetsonNano:
         if self.SPI is None:
             raise RuntimeError('Cannot find sysfs_software_spi.so')
 
+        self.transfer = self.SPI.SYSFS_software_spi_transfer
+        self.transfer.argtypes = [c_ubyte]
+        self.transfer.restype = None
+
         import Jetson.GPIO
         self.GPIO = Jetson.GPIO
 
@@ -197,11 +254,12 @@ class JetsonNano:
         time.sleep(delaytime / 1000.0)
 
     def spi_writebyte(self, data):
-        self.SPI.SYSFS_software_spi_transfer(data[0])
+        self.transfer(data[0])
 
     def spi_writebyte2(self, data):
-        for i in range(len(data)):
-            self.SPI.SYSFS_software_spi_transfer(data[i])
+        transfer = self.transfer
+        for byte in data:
+            transfer(byte)
 
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
@@ -244,6 +302,7 @@ class SunriseX3:
 
         self.GPIO = Hobot.GPIO
         self.SPI = spidev.SpiDev()
+        self.chunk_size = spi_chunk_size()
 
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
@@ -260,7 +319,8 @@ class SunriseX3:
     def spi_writebyte2(self, data):
         # for i in range(len(data)):
         #     self.SPI.writebytes([data[i]])
-        self.SPI.xfer3(data)
+        for chunk in iter_chunks(data, self.chunk_size):
+            self.SPI.xfer3(chunk.tobytes())
 
     def module_init(self):
         if self.Flag == 0:
@@ -296,22 +356,143 @@ class SunriseX3:
         self.GPIO.cleanup([self.RST_PIN, self.DC_PIN, self.CS_PIN, self.BUSY_PIN], self.PWR_PIN)
 
 
-if sys.version_info[0] == 2:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE)
-else:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE, text=True)
-output, _ = process.communicate()
-if sys.version_info[0] == 2:
-    output = output.decode(sys.stdout.encoding)
+class NullBackend:
+    """Backend for hosts without a panel.
+
+    GPIO writes are ignored and BUSY always reads idle. With dump_path set,
+    the data of each DATA_START_TRANSMISSION (0x10) command, i.e. each whole
+    frame, overwrites that file.
+    """
+    # Pin definition
+    RST_PIN = 17
+    DC_PIN = 25
+    CS_PIN = 8
+    BUSY_PIN = 24
+    PWR_PIN = 18
+
+    DATA_START_TRANSMISSION = 0x10
+
+    def __init__(self, dump_path=None):
+        self.dump_path = dump_path
+        self._dc = 1
+        self._command = None
 
-if "Raspberry" in output:
-    implementation = RaspberryPi()
-elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
-    implementation = SunriseX3()
-else:
-    implementation = JetsonNano()
+    def digital_write(self, pin, value):
+        if pin == self.DC_PIN:
+            self._dc = value
 
-for func in [x for x in dir(implementation) if not x.startswith('_')]:
-    setattr(sys.modules[__name__], func, getattr(implementation, func))
+    def digital_read(self, pin):
+        return 1
+
+    def delay_ms(self, delaytime):
+        pass
+
+    def spi_writebyte(self, data):
+        # DC low: the byte is a command, which tells what the data after it is
+        if not self._dc:
+            self._command = data[0]
+
+    def spi_writebyte2(self, data):
+        if not self._dc:
+            self._command = data[0]
+        elif self.dump_path and self._command == self.DATA_START_TRANSMISSION:
+            with open(self.dump_path, 'wb') as f:
+                f.write(bytes(data))
+
+    def module_init(self, cleanup=False):
+        return 0
+
+    def module_exit(self, cleanup=False):
+        pass
+
+
+BACKENDS = {
+    'raspberrypi': RaspberryPi,
+    'jetson': JetsonNano,
+    'sunrise': SunriseX3,
+    'null': NullBackend,
+}
+
+# Selected on first use; see use_backend()
+implementation = None
+_exported = []
+
+
+def detect_backend():
+    for path in ('/proc/device-tree/model', '/proc/cpuinfo'):
+        try:
+            with open(path, errors='ignore') as f:
+                if 'Raspberry' in f.read():
+                    return 'raspberrypi'
+        except OSError:
+            pass
+    if os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
+        return 'sunrise'
+    return 'jetson'
+
+
+def create_backend(name):
+    if name.startswith('file:'):
+        return NullBackend(name[len('file:'):])
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError('Unknown EPD backend %r, expected one of %s or file:<path>'
+                         % (name, ', '.join(BACKENDS))) from None
+
+
+def use_backend(backend=None):
+    """Select the hardware backend.
+
+    backend is an instance, a name from BACKENDS, 'file:<path>' for a
+    NullBackend that dumps frames to <path>, or None to use $EPD_BACKEND
+    and fall back to detecting the board.
+    """
+    global implementation
+    if backend is None:
+        backend = os.environ.get('EPD_BACKEND') or detect_backend()
+    if isinstance(backend, str):
+        logger.debug("Using EPD backend %s", backend)
+        backend = create_backend(backend)
+
+    module = sys.modules[__name__]
+    for name in _exported:
+        delattr(module, name)
+    _exported.clear()
+    for name in [x for x in dir(backend) if not x.startswith('_')]:
+        if name not in ('spi_writebyte', 'spi_writebyte2'):
+            setattr(module, name, getattr(backend, name))
+            _exported.append(name)
+    implementation = backend
+    return backend
+
+
+def get_backend():
+    if implementation is None:
+        use_backend()
+    return implementation
+
+
+def __getattr__(name):
+    # Only reached for names the backend has not exported yet, so the
+    # board is probed on first use rather than at import
+    if implementation is None:
+        use_backend()
+        return getattr(sys.modules[__name__], name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def spi_writebyte(data):
+    backend = get_backend()
+    start = time.monotonic()
+    backend.spi_writebyte(data)
+    spi_stats.add(len(data), time.monotonic() - start)
+
+
+def spi_writebyte2(data):
+    backend = get_backend()
+    start = time.monotonic()
+    backend.spi_writebyte2(data)
+    spi_stats.add(len(data), time.monotonic() - start)
 
 ### END OF FILE ###
\ No newline at end of file